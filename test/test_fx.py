@@ -4,6 +4,7 @@ import operator
 import numbers
 import pickle
 import copy
+import threading
 from pathlib import Path
 from torch.fx import symbolic_trace, Proxy, Node, GraphModule, Tracer, Graph
 from torch.fx.experimental import GraphManipulation
@@ -11,6 +12,7 @@ from torch.fx.experimental import shape_prop
 from torch.fx.experimental.subgraph_creation_example import split_module
 from torch.fx.immutable_collections import immutable_dict, immutable_list
 from copy import deepcopy
+from unittest import mock
 
 from torch.fx.proxy import TraceError
 
@@ -471,6 +473,24 @@ class TestFX(JitTestCase):
             self.assertTrue(hasattr(n, 'tag'))
             self.assertEqual(n.tag, 'foo')
 
+    def test_create_proxy_sees_placeholders(self):
+        class RecordingTracer(Tracer):
+            def __init__(self):
+                super().__init__()
+                self.kinds = []
+
+            def create_proxy(self, kind, target, args, kwargs, name=None, type_expr=None):
+                self.kinds.append(kind)
+                return super().create_proxy(kind, target, args, kwargs, name, type_expr)
+
+        class M(torch.nn.Module):
+            def forward(self, a, b, *args, **kwargs):
+                return a + b
+
+        tracer = RecordingTracer()
+        tracer.trace(M())
+        self.assertEqual(tracer.kinds, ['placeholder'] * 4 + ['call_function'])
+
     def test_tensor_attribute(self):
         class TensorAttribute(torch.nn.Module):
             def __init__(self):
@@ -497,6 +517,219 @@ class TestFX(JitTestCase):
         traced2.graph.lint(traced2)
         traced2(torch.rand(4, 4))
 
+    def test_buffer_attribute(self):
+        class BufferAttribute(torch.nn.Module):
+            def __init__(self):
+                super().__init__()
+                self.register_buffer('buf', torch.rand(3, 4))
+
+            def forward(self, x):
+                return x + self.buf
+
+        class WrapperForQualname(torch.nn.Module):
+            def __init__(self):
+                super().__init__()
+                self.ba = BufferAttribute()
+
+            def forward(self, x):
+                return self.ba(x) + self.ba.buf
+
+        wfq = WrapperForQualname()
+        traced = symbolic_trace(wfq)
+        traced.graph.lint(traced)
+        get_attr_targets = [n.target for n in traced.graph.nodes if n.op == 'get_attr']
+        self.assertEqual(get_attr_targets, ['ba.buf', 'ba.buf'])
+        x = torch.rand(3, 4)
+        self.assertEqual(traced(x), wfq(x))
+
+    def test_module_call_from_other_thread(self):
+        lin = torch.nn.Linear(4, 4)
+        results = []
+
+        class SpawnsThread(torch.nn.Module):
+            def forward(self, x):
+                t = threading.Thread(target=lambda: results.append(lin(torch.rand(2, 4))))
+                t.start()
+                t.join()
+                return x
+
+        traced = symbolic_trace(SpawnsThread())
+        traced.graph.lint(traced)
+        self.assertEqual(len(results), 1)
+        self.assertIsInstance(results[0], torch.Tensor)
+
+    def test_attributes_installed_during_trace(self):
+        class Child(torch.nn.Module):
+            def forward(self, x):
+                return x
+
+        class InstallsAttributes(torch.nn.Module):
+            def __init__(self):
+                super().__init__()
+                # The same submodule under two names, visited before `c`
+                self.a = Child()
+                self.b = self.a
+                self.c = Child()
+
+            def forward(self, x):
+                self.register_buffer('late_buf', torch.rand(3, 4))
+                self.c.register_buffer('late', torch.rand(3, 4))
+                self.late_lin = torch.nn.Linear(4, 4)
+                return self.late_lin(x + self.late_buf + self.c.late)
+
+        ia = InstallsAttributes()
+        searched, skipped = [], []
+        orig_search = torch.fx.symbolic_trace._search_for_tensor
+
+        def recording_search(m, a, seen=None):
+            (skipped if seen is not None and id(m) in seen else searched).append(m)
+            return orig_search(m, a, seen)
+
+        with mock.patch.object(torch.fx.symbolic_trace, '_search_for_tensor', recording_search):
+            traced = symbolic_trace(ia)
+        traced.graph.lint(traced)
+        get_attr_targets = [n.target for n in traced.graph.nodes if n.op == 'get_attr']
+        self.assertEqual(get_attr_targets, ['late_buf', 'c.late'])
+        call_module_targets = [n.target for n in traced.graph.nodes if n.op == 'call_module']
+        self.assertEqual(call_module_targets, ['late_lin'])
+        # `late_buf` is found on the root; `c.late` is found after searching
+        # the shared child once and skipping it under its second name
+        self.assertEqual(searched, [ia, ia, ia.a, ia.c])
+        self.assertEqual(skipped, [ia.a])
+        x = torch.rand(3, 4)
+        self.assertEqual(traced(x), torch.nn.functional.linear(x + ia.late_buf + ia.c.late,
+                                                               ia.late_lin.weight, ia.late_lin.bias))
+
+    def test_parameter_registered_during_trace(self):
+        class InstallsLinear(torch.nn.Module):
+            def forward(self, x):
+                self.late_lin = torch.nn.Linear(4, 4)
+                return torch.nn.functional.linear(x, self.late_lin.weight, self.late_lin.bias)
+
+        il = InstallsLinear()
+        traced = symbolic_trace(il)
+        traced.graph.lint(traced)
+        get_attr_targets = [n.target for n in traced.graph.nodes if n.op == 'get_attr']
+        self.assertEqual(get_attr_targets, ['late_lin.weight', 'late_lin.bias'])
+        x = torch.rand(3, 4)
+        self.assertEqual(traced(x), il.late_lin(x))
+
+    def test_tensor_attribute_reassigned_during_trace(self):
+        class ReassignsTensor(torch.nn.Module):
+            def __init__(self):
+                super().__init__()
+                self.t = torch.rand(3, 4)
+
+            def forward(self, x):
+                old = self.t
+                self.t = old * 2
+                return x + old + self.t
+
+        rt = ReassignsTensor()
+        old = rt.t
+        traced = symbolic_trace(rt)
+        traced.graph.lint(traced)
+        get_attr_targets = [n.target for n in traced.graph.nodes if n.op == 'get_attr']
+        self.assertEqual(get_attr_targets, ['__tensor_constant0', 't'])
+        x = torch.rand(3, 4)
+        self.assertEqual(traced(x), x + old + old * 2)
+
+        class ReassignsBuffer(torch.nn.Module):
+            def __init__(self):
+                super().__init__()
+                self.register_buffer('mask', torch.rand(3, 4))
+
+            def forward(self, x):
+                old = self.mask
+                self.mask = old * 2
+                return x + old.detach()
+
+        rb = ReassignsBuffer()
+        old = rb.mask
+        traced = symbolic_trace(rb)
+        traced.graph.lint(traced)
+        get_attr_targets = [n.target for n in traced.graph.nodes if n.op == 'get_attr']
+        self.assertEqual(get_attr_targets, ['__tensor_constant0'])
+        self.assertEqual(traced(x), x + old)
+
+    def test_module_moved_during_trace(self):
+        class MovesSubmodule(torch.nn.Module):
+            def __init__(self):
+                super().__init__()
+                self.sub = torch.nn.ReLU()
+
+            def forward(self, x):
+                self.moved = self.sub
+                del self.sub
+                return self.moved(x)
+
+        traced = symbolic_trace(MovesSubmodule())
+        traced.graph.lint(traced)
+        call_module_targets = [n.target for n in traced.graph.nodes if n.op == 'call_module']
+        self.assertEqual(call_module_targets, ['moved'])
+
+    def test_tensor_attribute_alias(self):
+        class DetachedBuffer(torch.nn.Module):
+            def __init__(self):
+                super().__init__()
+                self.register_buffer('buf', torch.rand(3, 4))
+
+            def forward(self, x):
+                return x + self.buf.detach() + self.buf.t().contiguous().t()
+
+        db = DetachedBuffer()
+        traced = symbolic_trace(db)
+        traced.graph.lint(traced)
+        get_attr_targets = [n.target for n in traced.graph.nodes if n.op == 'get_attr']
+        self.assertEqual(get_attr_targets, ['buf', '__tensor_constant0'])
+        x = torch.rand(3, 4)
+        self.assertEqual(traced(x), db(x))
+
+        class UnkeyedBuffers(torch.nn.Module):
+            def __init__(self):
+                super().__init__()
+                self.register_buffer('sp', torch.eye(3, 4).to_sparse())
+                self.register_buffer('empty', torch.empty(0))
+
+            def forward(self, x):
+                return x + self.sp.to_dense(), torch.empty(0)
+
+        ub = UnkeyedBuffers()
+        traced = symbolic_trace(ub)
+        traced.graph.lint(traced)
+        get_attr_targets = [n.target for n in traced.graph.nodes if n.op == 'get_attr']
+        self.assertEqual(get_attr_targets, ['__tensor_constant0', '__tensor_constant1'])
+        self.assertEqual(traced(x), ub(x))
+
+    def test_concurrent_traces(self):
+        orig_call = torch.nn.Module.__call__
+        barrier = threading.Barrier(2, timeout=30)
+
+        class WaitsForOtherTrace(torch.nn.Module):
+            def __init__(self):
+                super().__init__()
+                self.lin = torch.nn.Linear(4, 4)
+
+            def forward(self, x):
+                barrier.wait()
+                return self.lin(x)
+
+        graphs = {}
+
+        def trace(i):
+            graphs[i] = Tracer().trace(WaitsForOtherTrace())
+
+        threads = [threading.Thread(target=trace, args=(i,)) for i in range(2)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertIs(torch.nn.Module.__call__, orig_call)
+        self.assertEqual(len(graphs), 2)
+        for g in graphs.values():
+            self.assertEqual([n.op for n in g.nodes], ['placeholder', 'call_module', 'output'])
+
     def test_symbolic_trace_sequential(self):
         class Simple(torch.nn.Module):
             def forward(self, x):
@@ -522,6 +755,28 @@ class TestFX(JitTestCase):
         traced.graph.lint(traced)
         traced(torch.rand(4, 4))
 
+    def test_tensor_constant_retrace(self):
+        class ConstTensors(torch.nn.Module):
+            def forward(self, x):
+                return x + torch.zeros(3, 4) + torch.ones(3, 4)
+
+        traced = symbolic_trace(ConstTensors())
+        setattr(traced, '__tensor_constant7', torch.rand(3, 4))
+        retraced = symbolic_trace(traced)
+        retraced.graph.lint(retraced)
+        get_attr_targets = [n.target for n in retraced.graph.nodes if n.op == 'get_attr']
+        self.assertEqual(get_attr_targets, ['__tensor_constant0', '__tensor_constant1'])
+
+        class NewConst(torch.nn.Module):
+            def forward(self, x):
+                return x + torch.zeros(3, 4)
+
+        root = NewConst()
+        setattr(root, '__tensor_constant7', torch.rand(3, 4))
+        g = Tracer().trace(root)
+        get_attr_targets = [n.target for n in g.nodes if n.op == 'get_attr']
+        self.assertEqual(get_attr_targets, ['__tensor_constant8'])
+
     def test_pickle_graphmodule(self):
         class Nested(torch.nn.Module):
             def __init__(self):
@@ -784,6 +1039,34 @@ class TestFX(JitTestCase):
         fxed_scripted = torch.jit.script(fxed)
         fxed_scripted(Pair(torch.rand(5), torch.rand(5)), torch.rand(5), 3)
 
+    def test_varargs_return_annotation(self):
+        class VarArgs(torch.nn.Module):
+            def forward(self, x : torch.Tensor, *args) -> torch.Tensor:
+                return x + args[0]
+
+        g = Tracer().trace(VarArgs())
+        nodes = list(g.nodes)
+        self.assertEqual(nodes[0].type, torch.Tensor)
+        self.assertEqual(nodes[-1].op, 'output')
+        self.assertEqual(nodes[-1].type, torch.Tensor)
+
+    def test_patched_code_keeps_filename(self):
+        from torch.fx.symbolic_trace import _patch_function
+        src = 'def forward(self, *args):\n    first = lambda: args[0]\n    return first()\n'
+        fns = []
+        for filename in ('<fx_test_a>', '<fx_test_b>'):
+            gbls : Dict[str, Any] = {}
+            exec(compile(src, filename, 'exec'), gbls)
+            fns.append(gbls['forward'])
+        patched = [_patch_function(fn, 2) for fn in fns]
+        self.assertEqual([p.__code__.co_filename for p in patched], ['<fx_test_a>', '<fx_test_b>'])
+        nested_filenames = [[c.co_filename for c in p.__code__.co_consts if isinstance(c, type(p.__code__))]
+                            for p in patched]
+        self.assertEqual(nested_filenames, [['<fx_test_a>'], ['<fx_test_b>']])
+        self.assertEqual(patched[1](None, (3,)), 3)
+        # Repeated patching of the same function reuses the patched code
+        self.assertIs(_patch_function(fns[0], 2).__code__, patched[0].__code__)
+
     def test_typename_print(self):
         graph : torch.fx.Graph = torch.fx.Graph()
         x : torch.fx.Node = graph.create_node('placeholder', 'x')
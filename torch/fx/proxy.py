@@ -1,6 +1,6 @@
 import dis
+import sys
 import torch
-import inspect
 import operator
 
 from .graph import magic_methods, reflectable_magic_methods, Graph
@@ -122,10 +122,7 @@ class Proxy:
         return self.tracer.create_proxy('call_method', '__call__', (self,) + args, kwargs)
 
     def __iter__(self) -> Iterable['Proxy']:
-        frame = inspect.currentframe()
-        assert frame is not None
-        calling_frame = frame.f_back
-        assert calling_frame is not None
+        calling_frame = sys._getframe(1)
         inst = list(dis.get_instructions(calling_frame.f_code))[calling_frame.f_lasti // 2]
         if inst.opname == 'UNPACK_SEQUENCE':
             return (self[i] for i in range(inst.argval))  # type: ignore
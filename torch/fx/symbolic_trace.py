@@ -1,6 +1,10 @@
+import contextlib
 import inspect
+import sys
+import threading
+from itertools import islice
 from types import CodeType, FunctionType
-from typing import Any, Optional, List, Callable, Union
+from typing import Any, Dict, Iterator, Optional, List, Callable, Set, Tuple, Union
 import torch
 
 from .node import Argument
@@ -10,14 +14,165 @@ from .proxy import TracerBase
 
 HAS_VARSTUFF = inspect.CO_VARARGS | inspect.CO_VARKEYWORDS
 
+# Bound once so the checks in `Tracer.create_arg` don't go through the torch
+# namespace for every argument
+_Parameter = torch.nn.Parameter
+_Tensor = torch.Tensor
+
+# The Tracer currently tracing on this thread, if any. Module calls made
+# from other threads while a trace is in progress bypass interception.
+_tracing_tls = threading.local()
+
+# torch.nn.Module.__call__ is replaced by `_module_call_wrapper` for as long as
+# any thread is tracing. The count of active traces is guarded by the lock so
+# that concurrent traces don't clobber each other's patch.
+_patch_lock = threading.Lock()
+_patch_count = 0
+_orig_module_call = torch.nn.Module.__call__
+
+def _module_call_wrapper(mod, *args, **kwargs):
+    tracer = getattr(_tracing_tls, 'tracer', None)
+    if tracer is None:
+        return _orig_module_call(mod, *args, **kwargs)
+
+    entry = tracer._module_qualnames.get(id(mod))
+    if entry is not None and entry[0] is mod and _resolves_to(tracer.root, entry[1], mod):
+        module_qualified_name = entry[1]
+    else:
+        # Module may have been installed (or moved) after tracing started
+        module_qualified_name = sys.intern(_find_module(tracer.root, mod))
+        tracer._module_qualnames[id(mod)] = (mod, module_qualified_name)
+
+    def forward(*args, **kwargs):
+        return _orig_module_call(mod, *args, **kwargs)
+
+    return tracer.call_module(mod, module_qualified_name, forward, args, kwargs)
+
+@contextlib.contextmanager
+def _intercept_module_calls(tracer : 'Tracer') -> Iterator[None]:
+    """
+    Route module calls made on this thread to `tracer` for the duration of
+    the context
+    """
+    global _patch_count, _orig_module_call
+    with _patch_lock:
+        if _patch_count == 0:
+            _orig_module_call = torch.nn.Module.__call__
+            torch.nn.Module.__call__ = _module_call_wrapper  # type: ignore
+        _patch_count += 1
+    prev_tracer = getattr(_tracing_tls, 'tracer', None)
+    _tracing_tls.tracer = tracer
+    try:
+        yield
+    finally:
+        _tracing_tls.tracer = prev_tracer
+        with _patch_lock:
+            _patch_count -= 1
+            if _patch_count == 0:
+                torch.nn.Module.__call__ = _orig_module_call  # type: ignore
+
+def _resolves_to(root : torch.nn.Module, qualname : str, obj : Any) -> bool:
+    """
+    Whether `qualname` still refers to `obj` in the hierarchy under `root`.
+    Cached qualified names are checked with this before being trusted, since
+    attributes can be reassigned while tracing
+    """
+    for atom in qualname.split('.') if qualname else ():
+        root = getattr(root, atom, None)
+    return root is obj
+
 def _find_module(root: torch.nn.Module, m: torch.nn.Module):
     for n, p in root.named_modules():
         if m is p:
             return n
     raise NameError('module is not installed as a submodule')
 
-def _patch_function(fn: FunctionType, nargs: int) -> FunctionType:
-    co = fn.__code__
+def _walk_modules(m : torch.nn.Module, prefix : str,
+                  memo : Set[int]) -> Iterator[Tuple[str, torch.nn.Module]]:
+    """
+    Pre-order walk over the module hierarchy yielding `(qualname, module)`,
+    visiting each module once, in the same order as `named_modules()`
+    """
+    if id(m) in memo:
+        return
+    memo.add(id(m))
+    yield prefix, m
+    for name, child in m._modules.items():
+        if child is None:
+            continue
+        yield from _walk_modules(child, f'{prefix}.{name}' if prefix else name, memo)
+
+def _search_for_tensor(m : torch.nn.Module, a : torch.Tensor,
+                       seen : Optional[Set[int]] = None) -> Optional[List[str]]:
+    """
+    Search for a tensor value in the module's buffers and plain attributes.
+    If it's found, return the qualified name atoms of that attribute. If it's
+    not found, recurse down into child submodules, skipping any that have
+    already been visited. If it's not found there, return None
+    """
+    if seen is None:
+        seen = set()
+    if id(m) in seen:
+        return None
+    seen.add(id(m))
+    for n, b in m._buffers.items():
+        if a is b:
+            return [n]
+    for n, p in m.__dict__.items():
+        if a is p:
+            return [n]
+    for n, c in m._modules.items():
+        if c is None:
+            continue
+        maybe_result : Optional[List[str]] = _search_for_tensor(c, a, seen)
+        if maybe_result:
+            return [n] + maybe_result
+    return None
+
+def _tensor_storage_key(t : torch.Tensor) -> Optional[Tuple[Any, ...]]:
+    """
+    Return a key identifying exactly which data `t` views, such that two
+    Tensors with the same key are interchangeable as graph constants even
+    if they are different Python objects. Returns None for Tensors without
+    regular strided CPU/CUDA storage (e.g. XLA or batched Tensors, whose
+    storage() raises) and for empty Tensors, whose data_ptr() is always 0
+    """
+    if t.layout != torch.strided or t.is_quantized or t.device.type not in ('cpu', 'cuda'):
+        return None
+    if t.numel() == 0:
+        return None
+    return (t.storage().data_ptr(), t.storage_offset(), tuple(t.shape), t.stride(),
+            t.dtype, t.device, t.requires_grad)
+
+def _next_tensor_constant_id(root : torch.nn.Module) -> int:
+    """
+    Return the first index `i` such that no `__tensor_constant{j}` with
+    `j >= i` is already an attribute of `root` (e.g. when re-tracing a
+    GraphModule)
+    """
+    prefix = '__tensor_constant'
+    next_id = 0
+    for attrs in (root.__dict__, root._parameters, root._buffers, root._modules):
+        for name in attrs:
+            if name.startswith(prefix) and name[len(prefix):].isdigit():
+                next_id = max(next_id, int(name[len(prefix):]) + 1)
+    return next_id
+
+# Patched code objects are cached so that repeatedly tracing instances of the
+# same class doesn't rebuild the CodeType each time. The cache is keyed on the
+# identity of the original code object: code objects compare equal regardless
+# of where they (and any nested code in co_consts) were compiled, so an
+# equality-keyed cache could hand out another function's filename and line
+# numbers (e.g. for GraphModules, which each get their own
+# `<eval_with_key_N>` filename). Entries hold the original code so its id()
+# can't be reused while cached.
+_PATCHED_CODE_CACHE_SIZE = 128
+_patched_code_cache : Dict[Tuple[int, int], Tuple[CodeType, CodeType]] = {}
+
+def _patch_code(co: CodeType, nargs: int) -> CodeType:
+    entry = _patched_code_cache.get((id(co), nargs))
+    if entry is not None and entry[0] is co:
+        return entry[1]
     co_flags = co.co_flags & ~HAS_VARSTUFF
     co_args : tuple
     if hasattr(co, "co_posonlyargcount"):
@@ -37,6 +192,14 @@ def _patch_function(fn: FunctionType, nargs: int) -> FunctionType:
             co.co_name, co.co_firstlineno, co.co_lnotab,
             co.co_freevars, co.co_cellvars)
     new_code = CodeType(*co_args)  # type: ignore
+    if len(_patched_code_cache) >= _PATCHED_CODE_CACHE_SIZE:
+        # evict the oldest entry
+        del _patched_code_cache[next(iter(_patched_code_cache))]
+    _patched_code_cache[(id(co), nargs)] = (co, new_code)
+    return new_code
+
+def _patch_function(fn: FunctionType, nargs: int) -> FunctionType:
+    new_code = _patch_code(fn.__code__, nargs)
     return FunctionType(new_code, fn.__globals__, fn.__name__, fn.__defaults__, fn.__closure__)
 
     # we need to insert placeholder nodes for *args, and **kwargs,
@@ -46,16 +209,24 @@ def _patch_function(fn: FunctionType, nargs: int) -> FunctionType:
 class Tracer(TracerBase):
     def __init__(self):
         super().__init__()
+        # Default leaf-module decision per module type, see `is_leaf_module`
+        self._leaf_cache : Dict[type, bool] = {}
 
     def create_arg(self, a: Any) -> Argument:
         # The base tracer is used to construct Graphs when there is no associated
         # module hierarchy, so it can never create parameter references.
         # The default tracer adds the ability to refer to parameters when
         # tracing modules.
-        if isinstance(a, torch.nn.Parameter):
+        if isinstance(a, _Parameter):
+            entry = self._param_qualnames.get(id(a))
+            if entry is not None and entry[0] is a and _resolves_to(self.root, entry[1], a):
+                return self.create_node('get_attr', entry[1], (), {})
+            # The parameter may have been registered after tracing started
             for n, p in self.root.named_parameters():
                 if a is p:
-                    return self.create_node('get_attr', n, (), {})
+                    qualname = sys.intern(n)
+                    self._param_qualnames[id(a)] = (a, qualname)
+                    return self.create_node('get_attr', qualname, (), {})
             raise NameError('parameter is not a member of this module')
         # Tensors do not have a reliable string repr() from which they can be
         # constructed (and we probably don't want to rely on that, either), so
@@ -64,41 +235,48 @@ class Tracer(TracerBase):
         # a get_attr to retrieve that tensor. Otherwise, we'll store away the
         # tensor value into a special attribute on the Module s.t. we can
         # retrieve it with a get_attr.
-        if isinstance(a, torch.Tensor):
-            # TODO: slow
-            def search_for_tensor(m : torch.nn.Module) -> Optional[List[str]]:
-                """
-                Search for a tensor value in the module's attributes. If it's
-                found, return the qualified name of that attribute, given the
-                previous `qualname_atoms`. If it's not found, recurse down into
-                child submodules. If it's not found there, return None
-                """
-                for n, p in m.__dict__.items():
-                    if a is p:
-                        return [n]
-                for n, c in m.named_children():
-                    maybe_result : Optional[List[str]] = search_for_tensor(c)
-                    if maybe_result:
-                        return [n] + maybe_result
-                return None
+        if isinstance(a, _Tensor):
             # Retrieve the qualname for an existing Tensor attribute
-            qualname_atoms : Optional[List[str]] = search_for_tensor(self.root)
-            qualname = '.'.join(qualname_atoms) if qualname_atoms else None
+            entry = self._tensor_qualnames.get(id(a))
+            if entry is not None and entry[0] is a and _resolves_to(self.root, entry[1], a):
+                return self.create_node('get_attr', entry[1], (), {})
+
+            storage_key = _tensor_storage_key(a)
+            if storage_key is not None:
+                storage_entry = self._storage_qualnames.get(storage_key)
+                if storage_entry is not None and _resolves_to(self.root, storage_entry[1], storage_entry[0]):
+                    # A different Tensor object viewing exactly the same
+                    # data as an existing attribute (e.g. `self.buf.detach()`).
+                    # Don't remember its id(), it may be a temporary
+                    return self.create_node('get_attr', storage_entry[1], (), {})
+
+            # The attribute may have been assigned (or reassigned) after
+            # tracing started. Note this still walks the whole hierarchy, so
+            # the first reference to each new constant Tensor (e.g. a mask
+            # built in forward) costs O(size of the hierarchy); only repeated
+            # references to the same Tensor are constant time
+            qualname_atoms : Optional[List[str]] = _search_for_tensor(self.root, a)
+            qualname = sys.intern('.'.join(qualname_atoms)) if qualname_atoms else None
 
             # Tensor was not found in the Module hierarchy, stow it away in a
             # special attribute and set the qualname to refer to that
             if not qualname:
-                i = 0
-                while True:
-                    qualname = f'__tensor_constant{i}'
-                    if not hasattr(self.root, qualname):
-                        break
-                    i += 1
+                qualname = sys.intern(f'__tensor_constant{self._next_const_id}')
+                self._next_const_id += 1
                 setattr(self.root, qualname, a)
+            self._tensor_qualnames[id(a)] = (a, qualname)
+            if storage_key is not None:
+                self._storage_qualnames[storage_key] = (a, qualname)
 
             return self.create_node('get_attr', qualname, (), {})
         return super().create_arg(a)
 
+    def _add_tensor_qualname(self, t : torch.Tensor, qualname : str):
+        self._tensor_qualnames.setdefault(id(t), (t, qualname))
+        storage_key = _tensor_storage_key(t)
+        if storage_key is not None:
+            self._storage_qualnames.setdefault(storage_key, (t, qualname))
+
     def is_leaf_module(self, m: torch.nn.Module, module_qualified_name : str) -> bool:
         """
         A method to specify whether a given `nn.Module` is a "leaf" module.
@@ -117,7 +295,12 @@ class Tracer(TracerBase):
             submodule `bar`, which contains submodule `baz`, that module will
             appear with the qualified name `foo.bar.baz` here.
         """
-        return m.__module__.startswith('torch.nn') and not isinstance(m, torch.nn.Sequential)
+        t = type(m)
+        is_leaf = self._leaf_cache.get(t)
+        if is_leaf is None:
+            is_leaf = t.__module__.startswith('torch.nn') and not issubclass(t, torch.nn.Sequential)
+            self._leaf_cache[t] = is_leaf
+        return is_leaf
 
     def call_module(self, m: torch.nn.Module, module_qualified_name: str, forward: Callable[..., Any], args, kwargs):
         if not self.is_leaf_module(m, module_qualified_name):
@@ -133,47 +316,70 @@ class Tracer(TracerBase):
             fn = root
         self.graph = Graph()
 
+        # Maps from id() of each module, parameter and Tensor attribute (plain
+        # or buffer) in the hierarchy to the object and its qualified name, so
+        # that intercepted submodule calls and references to parameters and
+        # Tensors don't have to search the tree. Holding the object keeps its
+        # id() from being reused while tracing; hits are still checked with
+        # `_resolves_to` since attributes can be reassigned. Tensor constants
+        # that get stowed away on the root while tracing are added as we go.
+        # Names are interned since they end up as the targets of graph nodes
+        self._module_qualnames : Dict[int, Tuple[torch.nn.Module, str]] = {}
+        self._param_qualnames : Dict[int, Tuple[torch.nn.Parameter, str]] = {}
+        self._tensor_qualnames : Dict[int, Tuple[torch.Tensor, str]] = {}
+        # Tensor attributes keyed by the data they view, see `_tensor_storage_key`.
+        # The Tensor is held as well so its storage can't be freed and reused
+        # by another Tensor while tracing
+        self._storage_qualnames : Dict[Tuple[Any, ...], Tuple[torch.Tensor, str]] = {}
+        for mod_name, m in _walk_modules(self.root, '', set()):
+            self._module_qualnames[id(m)] = (m, sys.intern(mod_name))
+            prefix = mod_name + '.' if mod_name else ''
+            for n, p in m._parameters.items():
+                if p is not None:
+                    self._param_qualnames.setdefault(id(p), (p, sys.intern(prefix + n)))
+            for n, b in m._buffers.items():
+                if b is not None:
+                    self._add_tensor_qualname(b, sys.intern(prefix + n))
+            for n, val in m.__dict__.items():
+                if isinstance(val, torch.Tensor):
+                    self._add_tensor_qualname(val, sys.intern(prefix + n))
+        self._next_const_id = _next_tensor_constant_id(self.root)
+
         assert isinstance(fn, FunctionType)
         co = fn.__code__
         total_args = co.co_argcount + co.co_kwonlyargcount
-        names_iter = iter(co.co_varnames)
         args : List[Any] = []
         skip_arg_idx = 0
         if isinstance(root, torch.nn.Module):
-            skip_arg_idx = 1
-            next(names_iter)  # skip self
+            skip_arg_idx = 1  # skip self
             args.append(root)
 
+        # Looked up once rather than per placeholder. The annotations are taken
+        # before `fn` may be replaced by `_patch_function` below, since the
+        # patched function doesn't carry them over
+        create_proxy = self.create_proxy
+        annotations = fn.__annotations__
+
         def proxy_placeholder(name: str):
-            return self.create_proxy('placeholder', name, (), {},
-                                     type_expr=fn.__annotations__.get(name, None))
+            return create_proxy('placeholder', name, (), {},
+                                type_expr=annotations.get(name, None))
 
-        args.extend(proxy_placeholder(next(names_iter)) for _ in range(skip_arg_idx, total_args))
+        args.extend(proxy_placeholder(name) for name in islice(co.co_varnames, skip_arg_idx, total_args))
 
         if co.co_kwonlyargcount > 0 or co.co_flags & HAS_VARSTUFF:
+            # *args and **kwargs come right after the named arguments in co_varnames
+            var_idx = total_args
             # TODO: type annotations for *args and **kwargs
             if co.co_flags & inspect.CO_VARARGS:
-                args.append(proxy_placeholder('*' + next(names_iter)))
+                args.append(proxy_placeholder('*' + co.co_varnames[var_idx]))
+                var_idx += 1
             if co.co_flags & inspect.CO_VARKEYWORDS:
-                args.append(proxy_placeholder('**' + next(names_iter)))
+                args.append(proxy_placeholder('**' + co.co_varnames[var_idx]))
             fn = _patch_function(fn, len(args))
 
-        orig_call = torch.nn.Module.__call__
-
-        def module_call_wrapper(mod, *args, **kwargs):
-            module_qualified_name = _find_module(self.root, mod)
-
-            def forward(*args, **kwargs):
-                return orig_call(mod, *args, **kwargs)
-
-            return self.call_module(mod, module_qualified_name, forward, args, kwargs)
-
-        try:
-            torch.nn.Module.__call__ = module_call_wrapper
+        with _intercept_module_calls(self):
             self.create_node('output', 'output', (self.create_arg(fn(*args)),), {},
-                             type_expr=fn.__annotations__.get('return', None))
-        finally:
-            torch.nn.Module.__call__ = orig_call
+                             type_expr=annotations.get('return', None))
         return self.graph
 
 # Symbolic tracing API